@@ -25,7 +25,13 @@ from modal import Image, Mount, Secret, Stub, asgi_app, gpu, method
 GPU_CONFIG = gpu.A100(memory=80, count=2)
 MODEL_ID = "meta-llama/Llama-2-70b-chat-hf"
 REVISION = "36d9a7388cc80e5f4b3e9701ca2f250d21a96c30"
-# Add `["--quantize", "gptq"]` for TheBloke GPTQ models.
+# TGI rejects requests beyond this many at once, so the model class below keeps
+# its own concurrent requests under it.
+MAX_CONCURRENT_REQUESTS = 128
+# Inputs (i.e. requests to the model class) each container handles at once.
+CONCURRENT_INPUTS = 10
+# Add `["--quantize", "gptq"]` for TheBloke GPTQ models,
+# and drop `--dtype`, which can't be combined with it.
 LAUNCH_FLAGS = [
     "--model-id",
     MODEL_ID,
@@ -33,6 +39,21 @@ LAUNCH_FLAGS = [
     "8000",
     "--revision",
     REVISION,
+    # Cap the prompt tokens prefilled in one batch, the prompt plus generated
+    # tokens of each request, and the number of requests handled at once.
+    "--max-batch-prefill-tokens",
+    "4096",
+    "--max-total-tokens",
+    "4096",
+    "--max-concurrent-requests",
+    str(MAX_CONCURRENT_REQUESTS),
+    # Shard the model across both GPUs, in half precision.
+    "--sharded",
+    "true",
+    "--num-shard",
+    "2",
+    "--dtype",
+    "float16",
 ]
 
 # ## Define a container image
@@ -63,6 +84,27 @@ def download_model():
     )
 
 
+# ### Prefetch the weights
+# On container start, we ask the kernel to read all the weight shards into the page cache
+# in the background, while TGI boots. This way the launcher doesn't have to wait on disk
+# reads one shard at a time.
+
+
+def prefetch_weights():
+    import glob
+    import os
+
+    cache_dir = os.environ.get(
+        "HUGGINGFACE_HUB_CACHE", os.path.expanduser("~/.cache/huggingface/hub")
+    )
+    for path in glob.glob(f"{cache_dir}/**/*.safetensors", recursive=True):
+        fd = os.open(path, os.O_RDONLY)
+        try:
+            os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_WILLNEED)
+        finally:
+            os.close(fd)
+
+
 # ### Image definition
 # We’ll start from a Dockerhub image recommended by TGI, and override the default `ENTRYPOINT` for
 # Modal to run its own which enables seamless serverless deployments.
@@ -111,22 +153,37 @@ stub = Stub("example-tgi-" + MODEL_ID.split("/")[-1], image=image)
 @stub.cls(
     secret=Secret.from_name("huggingface"),
     gpu=GPU_CONFIG,
-    allow_concurrent_inputs=10,
+    allow_concurrent_inputs=CONCURRENT_INPUTS,
     container_idle_timeout=60 * 10,
     timeout=60 * 60,
 )
 class Model:
     def __enter__(self):
+        import asyncio
         import socket
         import subprocess
+        import threading
         import time
 
-        from text_generation import AsyncClient
-
+        threading.Thread(target=prefetch_weights, daemon=True).start()
+        # Import the client library while the launcher boots, rather than before.
+        client_import = threading.Thread(
+            target=__import__, args=("text_generation",)
+        )
+        client_import.start()
         self.launcher = subprocess.Popen(
             ["text-generation-launcher"] + LAUNCH_FLAGS
         )
+        client_import.join()
+
+        from text_generation import AsyncClient
+
         self.client = AsyncClient("http://127.0.0.1:8000", timeout=60)
+        # Shared by all `generate_batch` inputs. Leaves room for one request
+        # from each of the other concurrent inputs, e.g. streams.
+        self.batch_gate = asyncio.Semaphore(
+            MAX_CONCURRENT_REQUESTS - CONCURRENT_INPUTS
+        )
         self.template = """<s>[INST] <<SYS>>
 {system}
 <</SYS>>
@@ -148,8 +205,12 @@ class Model:
                     )
                 return False
 
+        # Poll frequently at first, then back off, so readiness is detected
+        # shortly after the webserver comes up.
+        delay = 0.05
         while not webserver_ready():
-            time.sleep(1.0)
+            time.sleep(delay)
+            delay = min(delay * 1.3, 0.25)
 
         print("Webserver ready!")
 
@@ -163,6 +224,27 @@ class Model:
 
         return result.generated_text
 
+    # To answer many questions at once, we send all the requests to TGI concurrently,
+    # so its continuous batching can process them together on the GPU.
+    @method()
+    async def generate_batch(self, questions: list[str]):
+        import asyncio
+
+        prompts = [
+            self.template.format(system="", user=question)
+            for question in questions
+        ]
+
+        # TGI rejects requests over its concurrency limit, so we cap how many
+        # are in flight at once.
+        async def generate(prompt):
+            async with self.batch_gate:
+                return await self.client.generate(prompt, max_new_tokens=1024)
+
+        results = await asyncio.gather(*(generate(p) for p in prompts))
+
+        return [result.generated_text for result in results]
+
     @method()
     async def generate_stream(self, question: str):
         prompt = self.template.format(system="", user=question)
@@ -177,13 +259,16 @@ class Model:
 # ## Run the model
 # We define a [`local_entrypoint`](/docs/guide/apps#entrypoints-for-ephemeral-apps) to invoke
 # our remote function. You can run this script locally with `modal run text_generation_inference.py`.
+# We answer several questions with a single `generate_batch` call, so they are generated together.
 @stub.local_entrypoint()
 def main():
-    print(
-        Model().generate.remote(
-            "Implement a Python function to compute the Fibonacci numbers."
-        )
-    )
+    questions = [
+        "Implement a Python function to compute the Fibonacci numbers.",
+        "What is the story about the fox and grapes?",
+        "Explain the difference between a process and a thread.",
+    ]
+    for answer in Model().generate_batch.remote(questions):
+        print(answer)
 
 
 # ## Serve the model